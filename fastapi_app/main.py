@@ -1,11 +1,15 @@
 import os
+import functools
 import hmac
 import hashlib
 import logging
+from collections.abc import Mapping
+from contextlib import asynccontextmanager
+from types import MappingProxyType
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from .sheets import SheetsDB
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, ConfigDict
+from .sheets import SheetsDB, SheetsUnavailable
 from dotenv import load_dotenv
 
 # --- Suggested Improvement: Configure Logging ---
@@ -21,102 +25,253 @@ if not PATREON_WEBHOOK_SECRET:
     # In a real app, you might raise an exception here to prevent it from starting
     # raise ValueError("FATAL: PATREON_WEBHOOK_SECRET environment variable not set.")
 
+# Encoded once here rather than on every webhook request.
+PATREON_WEBHOOK_SECRET_BYTES = (PATREON_WEBHOOK_SECRET or "").encode("utf-8")
+# Keyed once here; each webhook copies it instead of re-deriving the
+# padded key state for every request.
+_SIGNATURE_MAC = hmac.new(PATREON_WEBHOOK_SECRET_BYTES, digestmod=hashlib.md5)
+# Patreon member payloads are a few KB; anything this large is not a real delivery.
+MAX_WEBHOOK_BODY_BYTES = 1024 * 1024
+
+# Patreon member triggers the webhook acts on; anything else is acknowledged and ignored.
+_UPSERT_EVENTS = frozenset({
+    "members:create",
+    "members:update",
+    "members:pledge:create",
+    "members:pledge:update",
+})
+_DELETE_EVENTS = frozenset({"members:delete", "members:pledge:delete"})
+_HANDLED_EVENTS = _UPSERT_EVENTS | _DELETE_EVENTS
+
+# Shared read-only stand-in for missing payload sections.
+_EMPTY: Mapping = MappingProxyType({})
+
+# Typed just deep enough for the fields the handler reads, so pydantic's compiled
+# validator extracts them in the same pass that parses the JSON. Unknown keys are ignored.
+class ResourceIdentifier(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    type: str | None = None
+    id: str | None = None
+
+
+class IncludedResource(ResourceIdentifier):
+    attributes: dict | None = None
+
+
+class UserRelationship(BaseModel):
+    data: ResourceIdentifier | None = None
+
+
+class MemberRelationships(BaseModel):
+    user: UserRelationship | None = None
+
+
+class MemberResource(ResourceIdentifier):
+    relationships: MemberRelationships | None = None
+
+
 class WebhookEnvelope(BaseModel):
     event_type: str | None = None
     original_event_type: str | None = None
-    data: dict | None = None
-    included: list | None = None
+    data: MemberResource | list[MemberResource] | None = None
+    included: list[IncludedResource] | None = None
+
+
+@functools.cache
+def get_db() -> SheetsDB:
+    """Builds the Sheets-backed database on first use, so importing the app stays cheap."""
+    return SheetsDB.from_env()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Still fail fast on missing or bad Sheets config when the server starts.
+    db = get_db()
+    yield
+    # Don't lose patron changes that are still waiting on the delayed Sheets write.
+    await db.close()
 
 
-app = FastAPI(title="Patreon App Auth", version="0.1.0")
-db = SheetsDB.from_env()
+app = FastAPI(title="Patreon App Auth", version="0.1.0", lifespan=lifespan)
 
 
 @app.get("/check_patron/{user_id}")
-async def check_patron_status(user_id: str):
+async def check_patron_status(user_id: str) -> dict:
     """
     Checks if a user exists in the database.
     This is the endpoint the Tkinter app calls for authorization.
     """
-    logging.info(f"Checking patron status for user_id: {user_id}")
-    patron_data = await db.get_user(user_id)
+    logging.info("Checking patron status for user_id: %s", user_id)
+    patron_data = await get_db().get_user(user_id)
 
     if patron_data is not None:
-        logging.info(f"Patron found: {user_id}")
+        logging.info("Patron found: %s", user_id)
         return {"is_patron": True, "user_id": user_id, "data": patron_data}
     else:
-        logging.warning(f"Patron not found: {user_id}")
+        logging.warning("Patron not found: %s", user_id)
         raise HTTPException(
             status_code=404, 
             detail="Patron not found"
         )
 
 
+# Health checks are the most frequent request, so the body is encoded once up front.
+_HEALTH_BODY = b'{"status":"ok"}'
+
+
 @app.get("/health")
-async def health() -> dict:
-    return {"status": "ok"}
+async def health() -> Response:
+    return Response(content=_HEALTH_BODY, media_type="application/json")
+
+
+def decode_signature(signature: str | None) -> bytes | None:
+    """Returns the raw digest from an X-Patreon-Signature header, or None if malformed."""
+    # The hex length of an MD5 signature is a protocol constant, not a secret,
+    # so malformed headers can be rejected before reading or hashing the body.
+    if not signature or len(signature) != 2 * _SIGNATURE_MAC.digest_size:
+        return None
+    try:
+        return bytes.fromhex(signature)
+    except ValueError:
+        return None
 
 
-def verify_signature(secret: str, signature: str | None, body: bytes) -> bool:
-    if not signature:
-        return False
+def verify_signature(mac: hmac.HMAC, provided: bytes) -> bool:
+    """Checks a decoded signature against a MAC that has been fed the whole body."""
     # Patreon's signature is the MD5 hash of the webhook body, using the secret as the key.
-    expected = hmac.new(secret.encode("utf-8"), body, hashlib.md5).hexdigest()
-    return hmac.compare_digest(expected, signature)
+    # Compare the raw 16-byte digests rather than their hex encodings.
+    return hmac.compare_digest(mac.digest(), provided)
+
+
+def _index_included(
+    included: list[IncludedResource] | None,
+) -> dict[tuple[str, str], IncludedResource]:
+    """Index a JSON:API "included" list by (type, id) in a single pass."""
+    return {(item.type, item.id): item for item in included or ()}
+
+
+def _find_user_attributes(
+    included: dict[tuple[str, str], IncludedResource], user_id: str
+) -> Mapping:
+    """Returns the included user's attributes, or an empty mapping if absent."""
+    item = included.get(("user", user_id))
+    return (item and item.attributes) or _EMPTY
+
+
+def _member_user_id(member: MemberResource | None) -> str | None:
+    """Returns the id of the user a member resource points at, if any."""
+    if member is None or member.type != "member":
+        return None
+    try:
+        return member.relationships.user.data.id
+    except AttributeError:
+        return None  # One of the optional sections is missing
 
 
 @app.post("/webhook")
 async def patreon_webhook(
     request: Request,
     x_patreon_signature: str | None = Header(default=None, alias="X-Patreon-Signature"),
-):
-    body = await request.body()
-    
-    if not verify_signature(PATREON_WEBHOOK_SECRET, x_patreon_signature, body):
+    x_patreon_event: str | None = Header(default=None, alias="X-Patreon-Event"),
+) -> dict:
+    # Without a secret every body would verify against an empty HMAC key, so fail closed.
+    if not PATREON_WEBHOOK_SECRET_BYTES:
+        logging.error("Rejecting webhook: PATREON_WEBHOOK_SECRET is not configured.")
+        raise HTTPException(status_code=500, detail="Webhook secret not configured")
+
+    # Reject oversized or non-JSON deliveries before buffering the body or hashing it.
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        raise HTTPException(status_code=411, detail="Content-Length required")
+    # isdigit() alone accepts digits like "²" that int() then rejects.
+    if not (content_length.isascii() and content_length.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    # Too many digits can't be under the cap, and int() refuses strings over 4300 digits.
+    if len(content_length) > len(str(MAX_WEBHOOK_BODY_BYTES)):
+        raise HTTPException(status_code=413, detail="Payload too large")
+    if int(content_length) > MAX_WEBHOOK_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    # Also accept structured-syntax JSON types such as JSON:API's application/vnd.api+json.
+    media_type = request.headers.get("content-type", "").partition(";")[0].strip().lower()
+    if media_type != "application/json" and not (
+        media_type.startswith("application/") and media_type.endswith("+json")
+    ):
+        raise HTTPException(status_code=415, detail="Expected application/json")
+
+    provided_signature = decode_signature(x_patreon_signature)
+    if provided_signature is None:
+        logging.error("Webhook signature verification failed.")
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+    # Hash the body while it streams in rather than making a second pass over
+    # a fully buffered copy.
+    mac = _SIGNATURE_MAC.copy()
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_WEBHOOK_BODY_BYTES:  # Content-Length is only the client's claim
+            raise HTTPException(status_code=413, detail="Payload too large")
+        mac.update(chunk)
+
+    if not verify_signature(mac, provided_signature):
         logging.error("Webhook signature verification failed.")
         raise HTTPException(status_code=401, detail="Invalid signature")
     
     try:
-        envelope = WebhookEnvelope.model_validate_json(body.decode())
+        envelope = WebhookEnvelope.model_validate_json(body)
     except Exception as e:
-        logging.error(f"Failed to parse webhook JSON: {e}")
+        logging.error("Failed to parse webhook JSON: %s", e)
         raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
     
-    event_type = envelope.original_event_type or envelope.event_type
-    logging.info(f"Received webhook event: {event_type}")
-
-    # Extract user data from the "included" list for a more complete record
-    user_attributes = {}
-    if envelope.included:
-        for item in envelope.included:
-            if item.get("type") == "user":
-                user_attributes = item.get("attributes", {})
-                break # Found the user data, no need to loop further
-    
-    # Extract user ID from the main data block
-    user_id = None
-    if envelope.data and envelope.data.get("type") == "member":
-        user_data = envelope.data.get("relationships", {}).get("user", {}).get("data", {})
-        user_id = user_data.get("id")
-    
-    if not user_id:
+    # Patreon names the trigger in the X-Patreon-Event header; the body is a plain
+    # member document unless it was wrapped with event fields upstream.
+    event_type = envelope.original_event_type or envelope.event_type or x_patreon_event
+    logging.info("Received webhook event: %s", event_type)
+
+    # Bail out before touching the database for events we don't act on.
+    if event_type not in _HANDLED_EVENTS:
+        logging.info("Ignoring unhandled webhook event: %s", event_type)
+        return {"status": "ignored", "event_type": event_type}
+
+    # Patreon sends a single member, but accept a list so batched deliveries
+    # become one database update instead of being truncated to the first entry.
+    members = envelope.data if isinstance(envelope.data, list) else [envelope.data]
+    user_ids = [user_id for user_id in map(_member_user_id, members) if user_id]
+
+    if not user_ids:
         logging.warning("Webhook received but no user_id could be extracted.")
         return {"success": False, "detail": "No user ID found in payload"}
         
-    if event_type and ("delete" in event_type.lower() or "destroy" in event_type.lower()):
-        logging.info(f"Deleting patron due to '{event_type}' event. User ID: {user_id}")
-        await db.delete_user(user_id)
-        return {"status": "deleted", "user_id": user_id}
+    if event_type in _DELETE_EVENTS:
+        logging.info("Deleting patrons due to '%s' event. User IDs: %s", event_type, user_ids)
+        status = "deleted"
+        update = get_db().delete_users(user_ids)
     else:
-        # --- Suggested Improvement: Store more useful patron data ---
-        patron_data_to_store = {
-            "full_name": user_attributes.get("full_name"),
-            "email": user_attributes.get("email"),
-            "last_event": event_type,
-        }
-        logging.info(f"Upserting patron. User ID: {user_id}, Data: {patron_data_to_store}")
-        await db.upsert_user(user_id, patron_data_to_store)
-        return {"status": "upserted", "user_id": user_id}
+        # Pull each user's record from the "included" list for a more complete record
+        included = _index_included(envelope.included)
+        patrons = {}
+        for user_id in user_ids:
+            user_attributes = _find_user_attributes(included, user_id)
+            # --- Suggested Improvement: Store more useful patron data ---
+            patrons[user_id] = {
+                "full_name": user_attributes.get("full_name"),
+                "email": user_attributes.get("email"),
+                "last_event": event_type,
+            }
+        logging.info("Upserting patrons: %s", patrons)
+        status = "upserted"
+        update = get_db().upsert_users(patrons)
+
+    try:
+        await update
+    except SheetsUnavailable:
+        # A 5xx makes Patreon redeliver instead of the change being acknowledged and lost.
+        raise HTTPException(status_code=503, detail="Patron database unavailable")
+
+    if isinstance(envelope.data, list):
+        return {"status": status, "user_ids": user_ids}
+    return {"status": status, "user_id": user_ids[0]}
 
 
 # Compatibility route for existing infrastructure
@@ -124,5 +279,6 @@ async def patreon_webhook(
 async def patreon_webhook_compat(
     request: Request,
     x_patreon_signature: str | None = Header(default=None, alias="X-Patreon-Signature"),
-):
-    return await patreon_webhook(request, x_patreon_signature)
\ No newline at end of file
+    x_patreon_event: str | None = Header(default=None, alias="X-Patreon-Event"),
+) -> dict:
+    return await patreon_webhook(request, x_patreon_signature, x_patreon_event)
\ No newline at end of file
@@ -1,22 +1,81 @@
 import os
 import json
-from typing import Optional, Dict
+import time
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Iterable
 
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj) -> str:
+        # The Sheets API wants a str cell value; orjson returns bytes.
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:  # pragma: no cover - orjson is optional
+    _loads = json.loads
+
+    def _dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
 load_dotenv()  # This loads the variables from the .env file
 
 USERS_SHEET = "Users"
 # The cell that contains the entire JSON database object.
 DATABASE_CELL = f"{USERS_SHEET}!A1"
+# How long a fetched copy of the database is served from memory before
+# it is re-read from the sheet.
+CACHE_TTL_SECONDS = 60.0
+# Changes are written back this long after the first unflushed mutation,
+# so a burst of webhooks costs a single Sheets write.
+FLUSH_DELAY_SECONDS = 2.0
+# Flush right away once this many changes are waiting, instead of letting
+# a sustained burst pile up unwritten changes until the timer fires.
+FLUSH_MAX_PENDING = 50
+# Retries for 429/5xx responses; googleapiclient backs off exponentially with jitter.
+SHEETS_NUM_RETRIES = 3
+
+# Pending-change marker for a deleted user.
+_DELETED = object()
+
+
+class SheetsUnavailable(RuntimeError):
+    """Raised when the database cell can't be read or parsed."""
+
+
+def _apply_ops(data: Dict[str, Dict], ops: Dict[str, object]):
+    """Applies pending upserts and deletes to a database dict in place."""
+    for user_id, record in ops.items():
+        if record is _DELETED:
+            data.pop(user_id, None)
+        else:
+            data[user_id] = record
+
 
 class SheetsDB:
     def __init__(self, service, spreadsheet_id: str):
         self.service = service
         self.spreadsheet_id = spreadsheet_id
+        self._cache: Optional[Dict[str, Dict]] = None
+        self._cache_ts = 0.0
+        # Unflushed changes by user id: the record to store, or _DELETED. Flushes
+        # re-read the cell and replay these, so writes from other instances survive.
+        self._ops: Dict[str, object] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_now = asyncio.Event()
+        # Serializes Sheets I/O and cache refreshes. The shared googleapiclient
+        # service is not thread-safe, and a refresh racing a write could drop changes.
+        self._lock = asyncio.Lock()
+        # Calls are serialized anyway, so one dedicated thread is enough and keeps
+        # them from competing with other work in the loop's default executor.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
 
     @classmethod
     def from_env(cls) -> "SheetsDB":
@@ -28,57 +87,175 @@ class SheetsDB:
         try:
             info = json.loads(creds_json)
             creds = Credentials.from_service_account_info(info)
-            service = build("sheets", "v4", credentials=creds)
+            # Use the discovery document bundled with google-api-python-client so
+            # startup never fetches it over the network or probes for a cache backend.
+            service = build(
+                "sheets", "v4", credentials=creds, static_discovery=True, cache_discovery=False
+            )
             return cls(service, spreadsheet_id)
         except Exception as e:
             raise RuntimeError(f"Failed to initialize Sheets: {e}")
 
-    async def _get_database(self) -> Dict[str, Dict]:
-        """Helper to retrieve and parse the JSON object from the sheet."""
+    async def _get_database(self, strict: bool = False) -> Dict[str, Dict]:
+        """Helper to retrieve and parse the JSON object from the sheet.
+
+        Successful reads are cached for CACHE_TTL_SECONDS. Cache hits skip the
+        lock, so lookups never queue behind a write; concurrent misses share a
+        single fetch. A failed read falls back to the stale cached copy, or an
+        empty dict if there is none, or raises SheetsUnavailable if strict is set.
+        """
+        if self._cache_is_current():
+            return self._cache
+        async with self._lock:
+            # Another caller may have refreshed the cache while we waited.
+            if self._cache_is_current():
+                return self._cache
+            try:
+                return await self._read_database()
+            except SheetsUnavailable:
+                if strict:
+                    raise
+                # A stale copy beats nothing: it may hold acknowledged changes not yet written.
+                return self._cache if self._cache is not None else {}
+
+    def _cache_is_current(self) -> bool:
+        return self._cache is not None and time.monotonic() - self._cache_ts < CACHE_TTL_SECONDS
+
+    async def _read_database(self) -> Dict[str, Dict]:
+        """Fetches the JSON object from the sheet and refreshes the cache."""
+        data = await self._fetch_database()
+        # Unflushed local changes still win over what the sheet says.
+        _apply_ops(data, self._ops)
+        self._cache = data
+        self._cache_ts = time.monotonic()
+        return data
+
+    async def _fetch_database(self) -> Dict[str, Dict]:
+        """Reads and parses the JSON object from the sheet, raising SheetsUnavailable on failure."""
         try:
-            result = self.service.spreadsheets().values().get(
+            request = self.service.spreadsheets().values().get(
                 spreadsheetId=self.spreadsheet_id, range=DATABASE_CELL
-            ).execute()
+            )
+            result = await self._execute(request)
             
             values = result.get("values", [])
             if not values or not values[0]:
-                return {}  # Return empty dict if the cell is empty
-
+                return {}  # Empty dict if the cell is empty
             json_string = values[0][0]
-            return json.loads(json_string)
-        except HttpError as e:
-            print(f"SheetsDB._get_database error: {e}")
-            return {}
-        except (json.JSONDecodeError, IndexError) as e:
-            print(f"SheetsDB._get_database: Failed to parse JSON from sheet: {e}")
-            return {} # Return empty dict if data is corrupted or not valid JSON
+            return _loads(json_string)
+        except (ValueError, IndexError) as e:
+            # Never treat a corrupted cell as empty: a flush would overwrite it.
+            logging.error("SheetsDB._fetch_database: Failed to parse JSON from sheet: %s", e)
+            raise SheetsUnavailable(f"Failed to parse JSON from sheet: {e}") from e
+        except Exception as e:
+            logging.error("SheetsDB._fetch_database error: %s", e)
+            raise SheetsUnavailable(f"Failed to read from sheet: {e}") from e
 
     async def _write_database(self, data: Dict[str, Dict]):
         """Helper to write the updated JSON object back to the sheet."""
-        try:
-            body = {"values": [[json.dumps(data)]]}
-            self.service.spreadsheets().values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range=DATABASE_CELL,
-                valueInputOption="RAW",
-                body=body
-            ).execute()
-        except HttpError as e:
-            print(f"SheetsDB._write_database error: {e}")
+        # Serialize here so later mutations can't race the upload.
+        body = {"values": [[_dumps(data)]]}
+        request = self.service.spreadsheets().values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=DATABASE_CELL,
+            valueInputOption="RAW",
+            body=body
+        )
+        await self._execute(request)
+
+    async def _execute(self, request):
+        """Runs a googleapiclient request, which blocks on HTTP, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(request.execute, num_retries=SHEETS_NUM_RETRIES)
+        )
+
+    def _record(self, ops: Dict[str, object]):
+        """Applies changes to the cached copy and queues them for the delayed flush."""
+        if self._cache is not None:
+            _apply_ops(self._cache, ops)
+        self._ops.update(ops)
+        if len(self._ops) >= FLUSH_MAX_PENDING:
+            self._flush_now.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keep going while changes arrive during a write, since this task is
+        # still running then and _record won't arm another one.
+        while self._ops:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), FLUSH_DELAY_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if not await self.flush():
+                    break  # Leave failed writes to the next mutation or close().
+            except Exception:
+                logging.exception("SheetsDB._flush_later: unexpected flush error")
+                break
+
+    async def flush(self) -> bool:
+        """Writes any pending changes back to the sheet.
+
+        The cell is re-read first and the pending changes replayed on top, so
+        changes written by other instances since our last read are kept.
+        Returns False if the write failed and the changes are still pending.
+        """
+        async with self._lock:
+            self._flush_now.clear()
+            if not self._ops:
+                return True
+            ops, self._ops = self._ops, {}
+            try:
+                data = await self._fetch_database()
+                _apply_ops(data, ops)
+                await self._write_database(data)
+            except Exception as e:
+                logging.error("SheetsDB.flush: keeping %d pending changes: %s", len(ops), e)
+                # Changes recorded during the failed write are newer, so they win.
+                ops.update(self._ops)
+                self._ops = ops
+                return False
+            # Anything recorded while the write was in flight is still pending.
+            _apply_ops(data, self._ops)
+            self._cache = data
+            self._cache_ts = time.monotonic()
+            return True
+
+    async def close(self):
+        """Writes pending changes now, drops the delayed flush and stops the I/O thread."""
+        await self.flush()
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._executor.shutdown(wait=False)
 
     async def upsert_user(self, user_id: str, data: dict):
         """Adds a new user or updates an existing one in the database."""
-        db = await self._get_database()
-        db[str(user_id)] = data
-        await self._write_database(db)
+        await self.upsert_users({user_id: data})
+
+    async def upsert_users(self, users: Dict[str, dict]):
+        """Adds or updates several users with a single pending write.
+
+        Raises SheetsUnavailable if the sheet can't be read, so callers can
+        report the failure instead of acknowledging a change.
+        """
+        await self._get_database(strict=True)
+        self._record({str(user_id): data for user_id, data in users.items()})
 
     async def delete_user(self, user_id: str):
         """Deletes a user from the database."""
-        db = await self._get_database()
-        user_id_str = str(user_id)
-        if user_id_str in db:
-            del db[user_id_str]
-            await self._write_database(db)
+        await self.delete_users([user_id])
+
+    async def delete_users(self, user_ids: Iterable[str]):
+        """Deletes several users with a single pending write.
+
+        Raises SheetsUnavailable if the sheet can't be read.
+        """
+        await self._get_database(strict=True)
+        # Recorded even for users missing from our copy, which may predate
+        # another instance adding them.
+        self._record({key: _DELETED for key in map(str, user_ids)})
 
     async def get_user(self, user_id: str) -> Optional[Dict]:
         """Retrieves a single user's data from the database."""
@@ -87,4 +264,4 @@ class SheetsDB:
 
     async def list_users(self) -> Dict[str, Dict]:
         """Lists all users in the database."""
-        return await self._get_database()
\ No newline at end of file
+        return await self._get_database()
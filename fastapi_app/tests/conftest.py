@@ -6,4 +6,61 @@ ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
 
+# The webhook secret is read when fastapi_app.main is imported.
+os.environ.setdefault("PATREON_WEBHOOK_SECRET", "test-secret")
 
+import pytest
+
+from fastapi_app import main
+from fastapi_app.sheets import SheetsDB
+
+
+class FakeRequest:
+    def __init__(self, execute):
+        self._execute = execute
+
+    def execute(self, num_retries=0):
+        return self._execute()
+
+
+class FakeSheetsService:
+    """In-memory stand-in for the googleapiclient Sheets service, holding one cell."""
+
+    def __init__(self):
+        self.cell = ""
+        self.updates = 0
+        # Set to an exception to make the next request raise it.
+        self.fail_next = None
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _request(self, execute):
+        def run():
+            if self.fail_next is not None:
+                error, self.fail_next = self.fail_next, None
+                raise error
+            return execute()
+
+        return FakeRequest(run)
+
+    def get(self, spreadsheetId, range):
+        return self._request(lambda: {"values": [[self.cell]]} if self.cell else {})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def execute():
+            self.cell = body["values"][0][0]
+            self.updates += 1
+            return {}
+
+        return self._request(execute)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    sheets_db = SheetsDB(FakeSheetsService(), "test-sheet")
+    monkeypatch.setattr(main, "get_db", lambda: sheets_db)
+    return sheets_db
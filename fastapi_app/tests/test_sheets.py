@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import pytest
+
+from fastapi_app import sheets
+from fastapi_app.sheets import SheetsUnavailable
+
+
+def test_failed_write_keeps_changes_for_retry(db):
+    async def scenario():
+        await db.upsert_user("u1", {"email": "a@example.com"})
+        db.service.fail_next = TimeoutError("socket timed out")
+        assert await db.flush() is False
+        assert db.service.cell == ""
+
+        assert await db.flush() is True
+        assert json.loads(db.service.cell) == {"u1": {"email": "a@example.com"}}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_flush_keeps_changes_from_other_instances(db):
+    async def scenario():
+        db.service.cell = json.dumps({"u1": {}, "u2": {}})
+        await db.delete_user("u1")
+        await db.upsert_user("u3", {})
+        # Another instance writes after our cached read.
+        db.service.cell = json.dumps({"u1": {}, "u2": {}, "u4": {}})
+
+        assert await db.flush() is True
+        assert json.loads(db.service.cell) == {"u2": {}, "u3": {}, "u4": {}}
+        assert await db.get_user("u4") == {}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_mutation_raises_when_sheet_unreadable(db):
+    async def scenario():
+        db.service.fail_next = TimeoutError("socket timed out")
+        with pytest.raises(SheetsUnavailable):
+            await db.upsert_user("u1", {})
+        assert await db.flush() is True
+        assert db.service.updates == 0
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_burst_of_upserts_coalesces_into_one_write(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 0.05)
+
+    async def scenario():
+        for i in range(10):
+            await db.upsert_user(f"u{i}", {"n": i})
+        assert db.service.updates == 0
+        await asyncio.sleep(0.2)
+        assert db.service.updates == 1
+        assert len(json.loads(db.service.cell)) == 10
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_pending_threshold_flushes_before_the_delay(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 30.0)
+    monkeypatch.setattr(sheets, "FLUSH_MAX_PENDING", 3)
+
+    async def scenario():
+        await db.upsert_users({"u1": {}, "u2": {}})
+        await asyncio.sleep(0.05)
+        assert db.service.updates == 0
+        await db.upsert_user("u3", {})
+        await asyncio.sleep(0.05)
+        assert db.service.updates == 1
+        assert set(json.loads(db.service.cell)) == {"u1", "u2", "u3"}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_changes_made_during_a_write_are_flushed_too(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 0.05)
+
+    write_database = db._write_database
+
+    async def write_then_mutate(data):
+        await write_database(data)
+        if "u2" not in data:
+            # Lands while the delayed flush task is still running.
+            await db.upsert_user("u2", {})
+
+    monkeypatch.setattr(db, "_write_database", write_then_mutate)
+
+    async def scenario():
+        await db.upsert_user("u1", {})
+        await asyncio.sleep(0.3)
+        assert db.service.updates == 2
+        assert set(json.loads(db.service.cell)) == {"u1", "u2"}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_delayed_flush_is_retried_by_next_mutation(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 0.05)
+
+    async def scenario():
+        await db.upsert_user("u1", {})
+        db.service.fail_next = TimeoutError("socket timed out")
+        await asyncio.sleep(0.2)
+        assert db.service.cell == ""
+        await db.upsert_user("u2", {})
+        await asyncio.sleep(0.2)
+        assert set(json.loads(db.service.cell)) == {"u1", "u2"}
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_close_writes_pending_changes(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 30.0)
+
+    async def scenario():
+        await db.upsert_user("u1", {"email": "a@example.com"})
+        await db.close()
+        assert db.service.updates == 1
+        assert json.loads(db.service.cell) == {"u1": {"email": "a@example.com"}}
+
+    asyncio.run(scenario())
+
+
+def test_failed_refresh_serves_stale_cache(db, monkeypatch):
+    monkeypatch.setattr(sheets, "FLUSH_DELAY_SECONDS", 30.0)
+
+    async def scenario():
+        await db.upsert_user("u1", {})
+        monkeypatch.setattr(sheets, "CACHE_TTL_SECONDS", 0.0)
+        db.service.fail_next = TimeoutError("socket timed out")
+        # Acknowledged but not yet written, so only the cached copy knows about u1.
+        assert await db.get_user("u1") == {}
+        await db.close()
+
+    asyncio.run(scenario())
@@ -1,6 +1,9 @@
+import asyncio
 import hmac
+import json
 import hashlib
 from fastapi.testclient import TestClient
+from fastapi_app import main
 from fastapi_app.main import app
 
 
@@ -17,9 +20,7 @@ def test_health():
     assert r.json()["status"] == "ok"
 
 
-def test_webhook_create(monkeypatch):
-    secret = "test-secret"
-    monkeypatch.setenv("PATREON_WEBHOOK_SECRET", secret)
+def test_webhook_create(db):
     body = {
         "data": {
             "type": "member",
@@ -27,18 +28,207 @@ def test_webhook_create(monkeypatch):
         },
         "original_event_type": "members:pledge:create",
     }
-    import json
-
     b = json.dumps(body).encode()
     r = client.post(
         "/webhook",
         content=b,
         headers={
-            "X-Patreon-Signature": sign(b, secret),
+            "X-Patreon-Signature": sign(b, "test-secret"),
+            "Content-Type": "application/json",
+            "X-Patreon-Event": "members:pledge:create",
+        },
+    )
+    assert r.status_code == 200
+    assert r.json() == {"status": "upserted", "user_id": "u1"}
+
+    r = client.get("/check_patron/u1")
+    assert r.status_code == 200
+    assert r.json()["data"]["last_event"] == "members:pledge:create"
+
+
+def test_webhook_rejects_bad_signature(db):
+    b = b'{"original_event_type": "members:pledge:create"}'
+    r = client.post(
+        "/webhook",
+        content=b,
+        headers={
+            "X-Patreon-Signature": "0" * 32,
+            "Content-Type": "application/json",
+        },
+    )
+    assert r.status_code == 401
+
+
+def test_webhook_ignores_unhandled_event(db):
+    b = b'{"original_event_type": "posts:publish"}'
+    r = client.post(
+        "/webhook",
+        content=b,
+        headers={
+            "X-Patreon-Signature": sign(b, "test-secret"),
+            "Content-Type": "application/json",
+        },
+    )
+    assert r.status_code == 200
+    assert r.json()["status"] == "ignored"
+
+
+def test_webhook_rejects_all_requests_without_secret(monkeypatch, db):
+    monkeypatch.setattr(main, "PATREON_WEBHOOK_SECRET_BYTES", b"")
+    monkeypatch.setattr(main, "_SIGNATURE_MAC", hmac.new(b"", digestmod=hashlib.md5))
+    b = b'{"data": {"type": "member", "relationships": {"user": {"data": {"id": "u1"}}}}, "original_event_type": "members:pledge:create"}'
+    r = client.post(
+        "/webhook",
+        content=b,
+        headers={
+            "X-Patreon-Signature": sign(b, ""),
+            "Content-Type": "application/json",
+        },
+    )
+    assert r.status_code == 500
+    assert client.get("/check_patron/u1").status_code == 404
+
+
+def test_webhook_reads_event_from_header(db):
+    # Real Patreon deliveries carry the trigger only in the X-Patreon-Event header.
+    b = b'{"data": {"type": "member", "relationships": {"user": {"data": {"id": "u2"}}}}}'
+    r = client.post(
+        "/patreon/webhooks",
+        content=b,
+        headers={
+            "X-Patreon-Signature": sign(b, "test-secret"),
+            "Content-Type": "application/json",
             "X-Patreon-Event": "members:pledge:create",
         },
     )
     assert r.status_code == 200
-    assert r.json()["success"] is True
+    assert r.json() == {"status": "upserted", "user_id": "u2"}
+    assert client.get("/check_patron/u2").json()["data"]["last_event"] == "members:pledge:create"
+
+
+def test_webhook_reports_unreadable_database(db):
+    db.service.fail_next = TimeoutError("socket timed out")
+    b = b'{"data": {"type": "member", "relationships": {"user": {"data": {"id": "u1"}}}}}'
+    r = client.post(
+        "/webhook",
+        content=b,
+        headers={
+            "X-Patreon-Signature": sign(b, "test-secret"),
+            "Content-Type": "application/json",
+            "X-Patreon-Event": "members:pledge:create",
+        },
+    )
+    assert r.status_code == 503
+
+
+def signed_headers(b: bytes, **extra) -> dict:
+    return {
+        "X-Patreon-Signature": sign(b, "test-secret"),
+        "Content-Type": "application/json",
+        "X-Patreon-Event": "members:pledge:create",
+        **extra,
+    }
+
+
+def test_webhook_requires_content_length(db):
+    r = client.post("/webhook", content=iter([b"{}"]), headers=signed_headers(b"{}"))
+    assert r.status_code == 411
+
+
+def test_webhook_rejects_invalid_content_length(db):
+    r = client.post("/webhook", content=b"{}", headers=signed_headers(b"{}", **{"Content-Length": "1e3"}))
+    assert r.status_code == 400
+
+
+def asgi_post_status(content_length: bytes) -> int:
+    """Posts to /webhook through the ASGI app directly, for headers the test client can't send."""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/webhook",
+        "raw_path": b"/webhook",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-length", content_length), (b"content-type", b"application/json")],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    return messages[0]["status"]
+
+
+def test_webhook_rejects_non_ascii_content_length(db):
+    assert asgi_post_status("²".encode("latin-1")) == 400
+
+
+def test_webhook_rejects_overlong_content_length(db):
+    # Longer than int() will convert, so it must be turned away before parsing.
+    assert asgi_post_status(b"9" * 5000) == 413
+
+
+def test_webhook_rejects_oversized_content_length(db):
+    b = b" " * (main.MAX_WEBHOOK_BODY_BYTES + 1)
+    r = client.post("/webhook", content=b, headers=signed_headers(b))
+    assert r.status_code == 413
+
+
+def test_webhook_caps_streamed_body(db):
+    # Content-Length is only the client's claim; the streamed body is capped too.
+    b = b" " * (main.MAX_WEBHOOK_BODY_BYTES + 1)
+    r = client.post("/webhook", content=b, headers=signed_headers(b, **{"Content-Length": "2"}))
+    assert r.status_code == 413
+
+
+def test_webhook_content_type_checks(db):
+    b = b'{"data": {"type": "member", "relationships": {"user": {"data": {"id": "u1"}}}}}'
+    # One client loop for both stored deliveries, so the db's flush task isn't orphaned.
+    with TestClient(app) as c:
+        for content_type in ("Application/JSON; charset=utf-8", "application/vnd.api+json"):
+            r = c.post("/webhook", content=b, headers=signed_headers(b, **{"Content-Type": content_type}))
+            assert r.status_code == 200
+        for content_type in ("text/plain", "application/jsonx", "text/x+json"):
+            r = c.post("/webhook", content=b, headers=signed_headers(b, **{"Content-Type": content_type}))
+            assert r.status_code == 415
+
+
+def test_webhook_batched_members(db, monkeypatch):
+    records = []
+    record = db._record
+
+    def spy(ops):
+        records.append(ops)
+        record(ops)
+
+    monkeypatch.setattr(db, "_record", spy)
+    members = [
+        {"type": "member", "relationships": {"user": {"data": {"id": user_id}}}}
+        for user_id in ("u1", "u2")
+    ]
+
+    # Entering the client runs the lifespan, whose close() flushes to the fake cell.
+    with TestClient(app) as c:
+        b = json.dumps({"data": members}).encode()
+        r = c.post("/webhook", content=b, headers=signed_headers(b))
+        assert r.status_code == 200
+        assert r.json() == {"status": "upserted", "user_ids": ["u1", "u2"]}
+        assert len(records) == 1
 
+        b = json.dumps({"data": members}).encode()
+        r = c.post("/webhook", content=b, headers=signed_headers(b, **{"X-Patreon-Event": "members:pledge:delete"}))
+        assert r.status_code == 200
+        assert r.json() == {"status": "deleted", "user_ids": ["u1", "u2"]}
+        assert len(records) == 2
 
+    assert json.loads(db.service.cell) == {}
+    assert db.service.updates == 1
@@ -1,5 +1,9 @@
+import os
+
 from fastapi_app.main import app
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # Keep a single worker process: each extra process would answer /check_patron
+    # from its own patron cache, which can be up to CACHE_TTL_SECONDS stale.
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
\ No newline at end of file